@@ -1,20 +1,51 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, g
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_session import Session
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-import qrcode
+import segno
 import io
-import base64
+import functools
+import itertools
 import os
-import json
+import secrets
+import logging
+import orjson
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import uuid
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 load_dotenv()
 
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+logger = logging.getLogger(__name__)
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson, for jsonify and everything else using app.json"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the str round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 # Fix for Render/Heroku proxy to ensure correct URL generation (https vs http)
 from werkzeug.middleware.proxy_fix import ProxyFix
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
@@ -22,6 +53,24 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 CORS(app)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev_secret_key_change_in_production')
 
+# Server-side sessions: keep Spotify token_info in Redis so only the session id
+# travels in the cookie (falls back to signed-cookie sessions without REDIS_URL)
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis.from_url(REDIS_URL),
+        SESSION_USE_SIGNER=True,
+        # Sliding expiry: every request re-saves a non-empty session and resets its
+        # Redis TTL, so guests keep their voter id (and vote count) for the whole
+        # event and idle sessions expire on their own. Empty sessions of anonymous
+        # hits are never stored.
+        SESSION_PERMANENT=True,
+        SESSION_REFRESH_EACH_REQUEST=True,
+        PERMANENT_SESSION_LIFETIME=timedelta(hours=12)
+    )
+    Session(app)
+
 # Spotify Configuration (production-safe)
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
@@ -37,18 +86,93 @@ if not SPOTIFY_REDIRECT_URI:
     missing.append("SPOTIFY_REDIRECT_URI")
 
 if missing:
-    print("WARNING: Missing environment variables:", ", ".join(missing))
+    logger.warning("Missing environment variables: %s", ", ".join(missing))
 
 # Database Handling
 DB_FILE = 'music_curator.db'
+DB_BUSY_TIMEOUT = 5.0  # seconds to wait for another writer before failing
 
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+# Hot-path statements. Each thread keeps its connection, and sqlite3 caches the
+# prepared statement per SQL string, so these are parsed once per thread
+SQL_STATEMENT_CACHE = 256
+SQL_EVENT = 'SELECT * FROM events WHERE code = ?'
+SQL_EVENT_CODE = 'SELECT code FROM events WHERE code = ?'
+SQL_EVENT_VERSION = 'SELECT version FROM events WHERE code = ?'
+SQL_BUMP_VERSION = 'UPDATE events SET version = version + 1 WHERE code = ?'
+SQL_LEADERBOARD = 'SELECT song_id, COUNT(*) as count FROM votes WHERE event_code = ? GROUP BY song_id ORDER BY count DESC, song_id'
+SQL_USER_VOTED_SONGS = 'SELECT song_id FROM votes WHERE event_code = ? AND user_id = ?'
+SQL_USER_VOTE_COUNT = 'SELECT COUNT(*) as count FROM votes WHERE event_code = ? AND user_id = ?'
+SQL_VOTE_INSERT = ('INSERT INTO votes (event_code, song_id, user_id) VALUES (?, ?, ?) '
+                   'ON CONFLICT DO NOTHING RETURNING 1')
+SQL_VOTE_DELETE = 'DELETE FROM votes WHERE event_code = ? AND song_id = ? AND user_id = ?'
+SQL_VOTE_COUNTERS = ('SELECT COALESCE(SUM(song_id = ?), 0) as song_c, COALESCE(SUM(user_id = ?), 0) as user_c '
+                     'FROM votes WHERE event_code = ? AND (song_id = ? OR user_id = ?)')
+SQL_VOTE_STATE = 'UPDATE events SET version = version + 1, total_voters = total_voters + ? WHERE code = ?'
+# An added_songs row is 'pending' while its playlist add is in flight and 'added'
+# once Spotify accepted it; a pending claim older than the cutoff is abandoned
+SQL_ADDED_SONGS = ("SELECT song_id FROM added_songs WHERE event_code = ? "
+                   "AND (status = 'added' OR claimed_at > ?)")
+SQL_IS_ADDED = ("SELECT 1 FROM added_songs WHERE event_code = ? AND song_id = ? "
+                "AND (status = 'added' OR claimed_at > ?)")
+SQL_CLAIM_ADDED = ("INSERT INTO added_songs (event_code, song_id, status, claimed_at) VALUES (?, ?, 'pending', ?) "
+                   "ON CONFLICT (event_code, song_id) DO UPDATE SET claimed_at = excluded.claimed_at "
+                   "WHERE status = 'pending' AND claimed_at <= ?")
+# Confirm and release match the claimed_at a claim wrote, so a worker whose claim
+# was taken over cannot touch the new owner's row
+SQL_CONFIRM_ADDED = ("UPDATE added_songs SET status = 'added' "
+                     "WHERE event_code = ? AND song_id = ? AND status = 'pending' AND claimed_at = ?")
+SQL_RELEASE_ADDED = ("DELETE FROM added_songs "
+                     "WHERE event_code = ? AND song_id = ? AND status = 'pending' AND claimed_at = ?")
+SQL_STALE_CLAIMS = "SELECT event_code, song_id FROM added_songs WHERE status = 'pending' AND claimed_at <= ?"
+SQL_USER_PLAYLIST = 'SELECT playlist_id FROM user_playlists WHERE spotify_user_id = ? AND name = ?'
+SQL_SAVE_USER_PLAYLIST = 'INSERT OR REPLACE INTO user_playlists (spotify_user_id, name, playlist_id) VALUES (?, ?, ?)'
+SQL_SAVE_USER_PLAYLIST_IF_NEW = 'INSERT OR IGNORE INTO user_playlists (spotify_user_id, name, playlist_id) VALUES (?, ?, ?)'
+SQL_ADMIN_TOKEN = 'SELECT token_info FROM admin_tokens WHERE spotify_user_id = ?'
+
+_db_local = threading.local()  # one pooled connection per worker thread
+
+def connect_db():
+    """Get this thread's long-lived connection, opening it on first use"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        # Autocommit mode: writes that must be atomic use transaction() explicitly
+        conn = sqlite3.connect(DB_FILE, isolation_level=None, timeout=DB_BUSY_TIMEOUT,
+                               cached_statements=SQL_STATEMENT_CACHE)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while a vote is being written
+        conn.executescript('PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-20000')
+        _db_local.conn = conn
     return conn
 
+def get_db():
+    """Get the connection for the current request"""
+    if 'db' not in g:
+        g.db = connect_db()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    # The connection stays open for the thread's next request; just make sure
+    # no transaction is left behind
+    conn = g.pop('db', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+@contextmanager
+def transaction(conn):
+    """Run the enclosed statements in one transaction, rolling back on error"""
+    # Every transaction here writes, so take the write lock up front: a deferred
+    # transaction that reads first can hit SQLITE_BUSY when it upgrades under WAL
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.execute('COMMIT')
+
 def init_db():
-    with get_db() as conn:
+    with transaction(connect_db()) as conn:
         conn.execute('''
             CREATE TABLE IF NOT EXISTS events (
                 code TEXT PRIMARY KEY,
@@ -59,8 +183,9 @@ def init_db():
                 created_at TEXT,
                 active INTEGER,
                 admin_token TEXT,
-                added_songs TEXT,
-                spotify_user_id TEXT
+                spotify_user_id TEXT,
+                total_voters INTEGER DEFAULT 0,
+                version INTEGER DEFAULT 0
             )
         ''')
         conn.execute('''
@@ -71,27 +196,96 @@ def init_db():
                 PRIMARY KEY (event_code, song_id, user_id)
             )
         ''')
-        conn.commit()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS added_songs (
+                event_code TEXT,
+                song_id TEXT,
+                status TEXT NOT NULL DEFAULT 'added',
+                claimed_at REAL,
+                PRIMARY KEY (event_code, song_id)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_playlists (
+                spotify_user_id TEXT,
+                name TEXT,
+                playlist_id TEXT,
+                PRIMARY KEY (spotify_user_id, name)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS admin_tokens (
+                spotify_user_id TEXT PRIMARY KEY,
+                token_info TEXT
+            )
+        ''')
+        # Reverse index (voter -> their votes) so per-user vote counts are range scans
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_votes_event_user ON votes (event_code, user_id, song_id)')
+        # Databases created before the total_voters counter need it added and backfilled
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(events)')}
+        if 'total_voters' not in columns:
+            conn.execute('ALTER TABLE events ADD COLUMN total_voters INTEGER DEFAULT 0')
+            conn.execute('UPDATE events SET total_voters = (SELECT COUNT(DISTINCT user_id) FROM votes WHERE event_code = events.code)')
+        # Vote version (bumped on every vote change) for snapshot and ETag validation
+        if 'version' not in columns:
+            conn.execute('ALTER TABLE events ADD COLUMN version INTEGER DEFAULT 0')
+        # Claims made before the pending/added split were only kept once the add
+        # succeeded or was still running, so existing rows count as added
+        added_columns = {row['name'] for row in conn.execute('PRAGMA table_info(added_songs)')}
+        if 'status' not in added_columns:
+            conn.execute("ALTER TABLE added_songs ADD COLUMN status TEXT NOT NULL DEFAULT 'added'")
+            conn.execute('ALTER TABLE added_songs ADD COLUMN claimed_at REAL')
+        # Older databases kept added songs as a JSON list on the event row;
+        # move them into the added_songs table and clear the column
+        if 'added_songs' in columns:
+            conn.execute('''
+                INSERT OR IGNORE INTO added_songs (event_code, song_id)
+                SELECT events.code, json_each.value FROM events, json_each(events.added_songs)
+                WHERE events.added_songs IS NOT NULL
+            ''')
+            conn.execute('UPDATE events SET added_songs = NULL WHERE added_songs IS NOT NULL')
+    # Per-song lookups are served by the primary key's (event_code, song_id)
+    # prefix; refresh the planner statistics so it picks the right index
+    connect_db().execute('ANALYZE')
 
 init_db()
 
 # Helper to serialize/deserialize sets and dicts for DB
 class DBAdapter:
-    @staticmethod
-    def adapt_set(s):
-        return json.dumps(list(s)) if s else '[]'
-    
-    @staticmethod
-    def convert_set(s):
-        return set(json.loads(s)) if s else set()
-    
     @staticmethod
     def adapt_json(d):
-        return json.dumps(d) if d else '{}'
+        return orjson.dumps(d).decode() if d else '{}'
     
     @staticmethod
     def convert_json(d):
-        return json.loads(d) if d else {}
+        return orjson.loads(d) if d else {}
+
+# Spotify clients share one pooled HTTP session and are reused per access token,
+# so repeated calls skip the TCP/TLS handshake
+MAX_SPOTIFY_CLIENTS = 256
+SPOTIFY_REQUEST_TIMEOUT = 10  # seconds per Spotify API/OAuth request
+_spotify_http = requests.Session()
+_spotify_http.mount('https://', HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    # Same policy as spotipy's own session: retry writes too (playlist adds and
+    # creates hit 429s), but never re-send a request whose response was lost
+    max_retries=Retry(total=3, read=False, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']))
+))
+_spotify_clients = {}  # access token -> spotipy.Spotify
+
+def get_spotify_client(token_info):
+    """Get the Spotify client for a token, creating it on first use"""
+    access_token = token_info['access_token']
+    sp = _spotify_clients.get(access_token)
+    if sp is None:
+        if len(_spotify_clients) >= MAX_SPOTIFY_CLIENTS:
+            # Drop the oldest client; its token has most likely expired by now
+            _spotify_clients.pop(next(iter(_spotify_clients)), None)
+        sp = spotipy.Spotify(auth=access_token, requests_session=_spotify_http, requests_timeout=SPOTIFY_REQUEST_TIMEOUT)
+        _spotify_clients[access_token] = sp
+    return sp
 
 def get_spotify_oauth():
     """Create Spotify OAuth object with correct scope format"""
@@ -99,31 +293,272 @@ def get_spotify_oauth():
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET,
         redirect_uri=SPOTIFY_REDIRECT_URI,
-        scope='playlist-modify-public playlist-modify-private'  # Proper space-separated format
+        scope='playlist-modify-public playlist-modify-private',  # Proper space-separated format
+        requests_timeout=SPOTIFY_REQUEST_TIMEOUT
     )
 
-def generate_qr_code(event_code):
-    """Generate QR code for event"""
-    try:
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        # Use external URL for QR code
-        join_url = url_for('join_event', event_code=event_code, _external=True)
-        print(f"[DEBUG] Generating QR for URL: {join_url}")
-        qr.add_data(join_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64
-        img_io = io.BytesIO()
-        img.save(img_io, 'PNG')
-        img_io.seek(0)
-        img_base64 = base64.b64encode(img_io.getvalue()).decode()
-        print(f"[DEBUG] QR Code base64 length: {len(img_base64)}")
-        return img_base64
-    except Exception as e:
-        print(f"[ERROR] QR Code generation failed: {e}")
+def _resolve_token(event_code=None, prefer_admin=False, event=None):
+    """Find the Spotify token for this request from the session or the event admin,
+    as (token_info, admin_id); admin_id is None when the token came from the session.
+    Pass an already loaded event row as event to skip reading it again"""
+    session_token = session.get('token_info')
+    admin_token, admin_id = None, None
+    if (event or event_code) and (prefer_admin or not session_token):
+        conn = get_db()
+        if event is None:
+            event = conn.execute(SQL_EVENT, (event_code,)).fetchone()
+        if event:
+            admin_token, admin_id = get_admin_token(conn, event) or None, event['admin_id']
+    
+    if admin_token and (prefer_admin or not session_token):
+        return admin_token, admin_id
+    return session_token, None
+
+def get_valid_token(event_code=None, prefer_admin=False, event=None):
+    """Resolve this request's token and refresh it before any Spotify call, saving a
+    refreshed token back where it came from; None if there is no token"""
+    token_info, admin_id = _resolve_token(event_code, prefer_admin, event)
+    if not token_info:
         return None
+    
+    valid_token = ensure_valid_token(token_info)
+    if valid_token is not token_info:
+        if admin_id:
+            save_admin_token(get_db(), admin_id, valid_token)
+        else:
+            session['token_info'] = valid_token
+    return valid_token
+
+def with_valid_token(unauthenticated_error, use_event_admin=True, validate=None):
+    """Route decorator: refresh the request's token up front and expose it as g.token_info
+    with its client as g.sp, answering 401 when there is no token. An optional validate()
+    runs first and may return an error response, so bad input never resolves a token"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if validate:
+                error = validate()
+                if error:
+                    return error
+            event_code = session.get('event_code') if use_event_admin else None
+            token_info = get_valid_token(event_code)
+            if not token_info:
+                logger.error("No authentication token found for %s", request.path)
+                return jsonify({'error': unauthenticated_error}), 401
+            g.token_info = token_info
+            g.sp = get_spotify_client(token_info)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@functools.lru_cache(maxsize=1024)
+def _qr_svg(join_url):
+    """Render a join URL as SVG bytes (memoized, the URL never changes for an event)"""
+    # Low error correction keeps the symbol small; SVG stays sharp at any display size
+    qr = segno.make(join_url, error='L')
+    
+    img_io = io.BytesIO()
+    qr.save(img_io, kind='svg', scale=10, border=5, dark='black', light='white',
+            xmldecl=False, svgclass=None, lineclass=None)
+    return img_io.getvalue()
+
+# New events render their QR code off the request thread, so create-event returns
+# immediately and the admin dashboard's first image request is already warm
+qr_executor = ThreadPoolExecutor(max_workers=2)
+
+# Spotify's maximum page size for search results, playlist listings and batched
+# track lookups; requesting full pages keeps round-trips to a minimum
+SPOTIFY_PAGE_LIMIT = 50
+
+def find_user_playlist(conn, sp, spotify_user_id, name):
+    """Id of the user's playlist with this name, or None; Spotify is only listed on a local miss"""
+    row = conn.execute(SQL_USER_PLAYLIST, (spotify_user_id, name)).fetchone()
+    if row:
+        return row['playlist_id']
+    
+    # Unknown name: record every playlist the user has, so later lookups stay local.
+    # Page through Spotify first; the write lock is only taken for the insert
+    rows = []
+    offset = 0
+    while True:
+        page = sp.current_user_playlists(limit=SPOTIFY_PAGE_LIMIT, offset=offset)
+        rows.extend((spotify_user_id, p['name'], p['id']) for p in page['items'])
+        if not page.get('next'):
+            break
+        offset += SPOTIFY_PAGE_LIMIT
+    with transaction(conn):
+        # INSERT OR IGNORE keeps the first playlist with a given name
+        conn.executemany(SQL_SAVE_USER_PLAYLIST_IF_NEW, rows)
+    row = conn.execute(SQL_USER_PLAYLIST, (spotify_user_id, name)).fetchone()
+    return row['playlist_id'] if row else None
+
+def get_voted_songs(conn, event_code, voter_id):
+    """Set of songs voter_id has voted for in an event"""
+    if not voter_id:
+        return set()
+    return {row[0] for row in conn.execute(SQL_USER_VOTED_SONGS, (event_code, voter_id))}
+
+# Track metadata is immutable per Spotify ID, so keep it across dashboard polls
+TRACK_CACHE_TTL = 6 * 60 * 60  # seconds
+MAX_TRACK_CACHE = 50000
+_track_cache = {}  # track id -> (expires_at, metadata)
+# Shared by all requests, so a big track list does not spin up threads per poll
+tracks_executor = ThreadPoolExecutor(max_workers=8)
+
+def _img(t):
+    """URL of a track's first album image, or '' if it has none"""
+    images = (t.get('album') or {}).get('images')
+    return images[0].get('url', '') if images else ''
+
+def track_metadata(t):
+    """Reduce a Spotify track object to the fields the dashboards display"""
+    return {
+        'id': t['id'],
+        'name': t['name'],
+        'artist': ', '.join([a['name'] for a in (t.get('artists') or [])]),
+        'image': _img(t),
+        'spotify_uri': t.get('uri')
+    }
+
+def cache_tracks(tracks):
+    """Store Spotify track objects in the metadata cache, returning their metadata"""
+    now = time.time()
+    result = []
+    for t in tracks:
+        if t:
+            meta = track_metadata(t)
+            _track_cache.pop(meta['id'], None)
+            _track_cache[meta['id']] = (now + TRACK_CACHE_TTL, meta)
+            result.append(meta)
+    if len(_track_cache) > MAX_TRACK_CACHE:
+        # Entries are kept in insertion order, so the oldest go first
+        for sid in list(itertools.islice(_track_cache, len(_track_cache) - MAX_TRACK_CACHE)):
+            _track_cache.pop(sid, None)
+    return result
+
+def missing_track_ids(song_ids):
+    """The song_ids whose metadata is not (or no longer) in the cache"""
+    now = time.time()
+    return [sid for sid in song_ids if _track_cache.get(sid, (0,))[0] <= now]
+
+def fetch_tracks_metadata(sp, missing):
+    """Ask Spotify for the metadata of missing track ids and cache it"""
+    # Fetch the chunks of at most SPOTIFY_PAGE_LIMIT ids concurrently
+    chunks = [missing[i:i+SPOTIFY_PAGE_LIMIT] for i in range(0, len(missing), SPOTIFY_PAGE_LIMIT)]
+    if len(chunks) == 1:
+        responses = [sp.tracks(chunks[0])]
+    else:
+        responses = list(tracks_executor.map(sp.tracks, chunks))
+    for resp in responses:
+        cache_tracks(resp.get('tracks', []))
+
+def get_tracks_metadata(song_ids):
+    """Cached metadata for song_ids, skipping any that are not cached"""
+    return [_track_cache[sid][1] for sid in song_ids if sid in _track_cache]
+
+# Events are never deleted, so a code once seen stays valid; misses are remembered
+# briefly so repeated bad codes skip the database too
+UNKNOWN_EVENT_TTL = 1  # seconds
+MAX_UNKNOWN_EVENTS = 10000
+_known_events = set()
+_unknown_events = {}  # event code -> expires_at
+
+def _known_missing(event_code):
+    return _unknown_events.get(event_code, 0) > time.time()
+
+def _remember_missing(event_code):
+    if len(_unknown_events) >= MAX_UNKNOWN_EVENTS:
+        _unknown_events.clear()
+    _unknown_events[event_code] = time.time() + UNKNOWN_EVENT_TTL
+
+def event_exists(conn, event_code):
+    """Whether an event with this code exists, answered from memory when possible"""
+    if event_code in _known_events:
+        return True
+    if _known_missing(event_code):
+        return False
+    
+    if conn.execute(SQL_EVENT_CODE, (event_code,)).fetchone():
+        _known_events.add(event_code)
+        return True
+    _remember_missing(event_code)
+    return False
+
+# Every open dashboard polls the same per-event aggregates; keep the last snapshot
+# and reuse it while the event's vote version (bumped by every vote) is unchanged,
+# which holds across workers since the version lives in the events row
+_event_snapshots = {}  # event code -> snapshot
+
+def load_event(conn, event_code):
+    """Get an event's row and its shared vote state as (event, snapshot), or (None, None)"""
+    if _known_missing(event_code):
+        return None, None
+    event = conn.execute(SQL_EVENT, (event_code,)).fetchone()
+    if not event:
+        _remember_missing(event_code)
+        return None, None
+    
+    cached = _event_snapshots.get(event_code)
+    if cached and cached['version'] == event['version']:
+        return event, cached
+    
+    # Count all votes for this event, most voted first (the leaderboard order)
+    votes_rows = conn.execute(SQL_LEADERBOARD, (event_code,)).fetchall()
+    snapshot = {
+        'code': event['code'],
+        'playlist_name': event['playlist_name'],
+        'threshold': event['threshold'],
+        'votes': {row['song_id']: row['count'] for row in votes_rows},
+        'total_voters': event['total_voters'],
+        'version': event['version']
+    }
+    _event_snapshots[event_code] = snapshot
+    return event, snapshot
+
+def get_event_snapshot(conn, event_code):
+    """Get the shared vote state of an event, or None if it does not exist"""
+    return load_event(conn, event_code)[1]
+
+# Dashboards follow vote changes over Server-Sent Events: a vote wakes the event's
+# streams in this worker, and streams re-check the vote version every
+# STREAM_CHECK_INTERVAL so changes made by other workers still arrive
+STREAM_CHECK_INTERVAL = 5  # seconds
+STREAM_MIN_INTERVAL = 1  # seconds, a burst of votes is sent as one message
+STREAM_MAX_AGE = 300  # seconds, the browser reconnects when a stream ends
+# Each open stream occupies one gunicorn thread for up to STREAM_MAX_AGE. The
+# Procfile runs gthread workers with 64 threads; cap the streams per worker
+# below that so votes, searches and bundle fetches always have threads left.
+# Dashboards turned away with 503 fall back to polling every 5 seconds.
+# Keep MAX_EVENT_STREAMS at least ~16 under --threads when changing either.
+MAX_EVENT_STREAMS = int(os.getenv('MAX_EVENT_STREAMS', '48'))
+_stream_slots = threading.BoundedSemaphore(MAX_EVENT_STREAMS)
+_vote_conditions = {}  # event code -> threading.Condition
+
+def notify_vote_changed(event_code):
+    """Wake this worker's streams for an event after its vote version was bumped"""
+    cond = _vote_conditions.get(event_code)
+    if cond:
+        with cond:
+            cond.notify_all()
+
+_event_stats = {}  # event code -> (version, stats payload)
+
+def build_event_stats(snapshot):
+    """Shape an event snapshot into the per-song stats payload (built once per vote version)"""
+    cached = _event_stats.get(snapshot['code'])
+    if cached and cached[0] == snapshot['version']:
+        return cached[1]
+    
+    # Snapshot votes are already ordered by vote count
+    threshold = snapshot['threshold']
+    stats = {
+        'songs': [{'song_id': song_id, 'votes': count, 'threshold': threshold}
+                  for song_id, count in snapshot['votes'].items()],
+        'total_voters': snapshot['total_voters'],
+        'threshold': threshold
+    }
+    _event_stats[snapshot['code']] = (snapshot['version'], stats)
+    return stats
 
 @app.route('/')
 def index():
@@ -135,10 +570,10 @@ def admin_login():
     try:
         sp_oauth = get_spotify_oauth()
         auth_url = sp_oauth.get_authorize_url()
-        print(f"[DEBUG] Redirecting to Spotify auth: {auth_url}")
+        logger.debug("Redirecting to Spotify auth: %s", auth_url)
         return redirect(auth_url)
     except Exception as e:
-        print(f"[ERROR] Login failed: {e}")
+        logger.error("Login failed: %s", e)
         return render_template('error.html', error=f"Login error: {str(e)}")
 
 @app.route('/callback')
@@ -150,235 +585,223 @@ def callback():
         error = request.args.get('error')
         
         if error:
-            print(f"[ERROR] Spotify error: {error}")
+            logger.error("Spotify error: %s", error)
             return render_template('error.html', error=f"Spotify error: {error}")
         
         if not code:
             return render_template('error.html', error="No authorization code received")
         
-        print(f"[DEBUG] Received auth code, exchanging for token...")
+        logger.debug("Received auth code, exchanging for token...")
         token_info = sp_oauth.get_access_token(code)
         
         session['token_info'] = token_info
         user_id = str(uuid.uuid4())
         session['user_id'] = user_id
-        # user_tokens removed as we rely on session and event storage
         
-        print(f"[DEBUG] Token received, redirecting to dashboard")
+        logger.debug("Token received, redirecting to dashboard")
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
-        print(f"[ERROR] Callback failed: {e}")
+        logger.error("Callback failed: %s", e)
         return render_template('error.html', error=f"Authentication error: {str(e)}")
 
 @app.route('/admin/dashboard')
 def admin_dashboard():
     """Admin dashboard"""
     if 'token_info' not in session:
-        print("[DEBUG] No token in session, redirecting to login")
+        logger.debug("No token in session, redirecting to login")
         return redirect(url_for('admin_login'))
     return render_template('admin_dashboard.html')
 
 @app.route('/api/create-event', methods=['POST'])
+@with_valid_token('Not authenticated. Please login first.', use_event_admin=False)
 def create_event():
     """Create a new voting event"""
     try:
         data = request.json
-        event_code = str(uuid.uuid4())[:8].upper()
-        
-        print(f"[DEBUG] Creating event: {event_code}")
+        event_code = secrets.token_hex(4).upper()
         
-        # Get token from session
-        token_info = session.get('token_info')
-        if not token_info:
-            print("[ERROR] No token in session")
-            return jsonify({'error': 'Not authenticated. Please login first.'}), 401
+        logger.debug("Creating event: %s", event_code)
         
-        # Initialize Spotify client
-        print("[DEBUG] Initializing Spotify client...")
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        # Spotify client for the session's (refreshed) token
+        sp = g.sp
         
         # Get current user
-        print("[DEBUG] Fetching user profile...")
+        logger.debug("Fetching user profile...")
         user_profile = sp.current_user()
-        print(f"[DEBUG] User: {user_profile['display_name']}")
+        logger.debug("User: %s", user_profile['display_name'])
         
         # Create or get playlist
         playlist_name = data.get('playlist_name')
         if not playlist_name:
             return jsonify({'error': 'Playlist name is required'}), 400
         
-        print(f"[DEBUG] Looking for playlist: {playlist_name}")
-        existing_playlists = sp.current_user_playlists()
-        
-        playlist = None
-        for p in existing_playlists['items']:
-            if p['name'] == playlist_name:
-                playlist = p
-                print(f"[DEBUG] Found existing playlist: {p['id']}")
-                break
+        logger.debug("Looking for playlist: %s", playlist_name)
+        conn = get_db()
+        playlist_id = find_user_playlist(conn, sp, user_profile['id'], playlist_name)
         
-        if not playlist:
-            print("[DEBUG] Creating new playlist...")
+        if playlist_id:
+            logger.debug("Found existing playlist: %s", playlist_id)
+        else:
+            logger.debug("Creating new playlist...")
             playlist = sp.user_playlist_create(
                 user=user_profile['id'],
                 name=playlist_name,
                 public=False,
                 description='Created by Music Curator'
             )
-            print(f"[DEBUG] Created playlist: {playlist['id']}")
+            playlist_id = playlist['id']
+            conn.execute(SQL_SAVE_USER_PLAYLIST, (user_profile['id'], playlist_name, playlist_id))
+            logger.debug("Created playlist: %s", playlist_id)
         
         # Store event details in DB
-        with get_db() as conn:
-            conn.execute('''
-                INSERT INTO events (
-                    code, playlist_name, playlist_id, threshold, admin_id, 
-                    created_at, active, admin_token, added_songs, spotify_user_id
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                event_code,
-                playlist_name,
-                playlist['id'],
-                int(data.get('threshold', 5)),
-                user_profile['id'],
-                datetime.now().isoformat(),
-                1, # Active
-                DBAdapter.adapt_json(token_info),
-                DBAdapter.adapt_set(set()),
-                user_profile['id']
-            ))
-            conn.commit()
+        with transaction(conn):
+            while True:
+                try:
+                    conn.execute('''
+                        INSERT INTO events (
+                            code, playlist_name, playlist_id, threshold, admin_id, 
+                            created_at, active, spotify_user_id
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (
+                        event_code,
+                        playlist_name,
+                        playlist_id,
+                        int(data.get('threshold', 5)),
+                        user_profile['id'],
+                        datetime.now().isoformat(),
+                        1, # Active
+                        user_profile['id']
+                    ))
+                    break
+                except sqlite3.IntegrityError:
+                    # Code already taken by another event (checked by the primary key,
+                    # so it holds across workers); draw a new one
+                    event_code = secrets.token_hex(4).upper()
+                    logger.debug("Event code collision, retrying with: %s", event_code)
+            save_admin_token(conn, user_profile['id'], g.token_info)
         
-        print(f"[DEBUG] Event created successfully in DB: {event_code}")
-        qr_code = generate_qr_code(event_code)
+        logger.debug("Event created successfully in DB: %s", event_code)
+        _known_events.add(event_code)
+        _unknown_events.pop(event_code, None)
+        qr_executor.submit(_qr_svg, url_for('join_event', event_code=event_code, _external=True))
         
         return jsonify({
             'success': True,
             'event_code': event_code,
-            'qr_code': qr_code,
+            'qr_url': url_for('event_qr_code', event_code=event_code),
             'playlist_name': playlist_name,
             'threshold': int(data.get('threshold', 5))
         })
     
     except Exception as e:
-        print(f"[ERROR] Create event failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Create event failed: %s", e)
         return jsonify({'error': f'Error creating event: {str(e)}'}), 400
 
 @app.route('/api/event/<event_code>')
 def get_event(event_code):
     """Get event details"""
-    with get_db() as conn:
-        event = conn.execute('SELECT * FROM events WHERE code = ?', (event_code,)).fetchone()
-        if not event:
-            return jsonify({'error': 'Event not found'}), 404
-        
-        # Count all votes for this event
-        votes_rows = conn.execute('SELECT song_id, COUNT(*) as count FROM votes WHERE event_code = ? GROUP BY song_id', (event_code,)).fetchall()
-        song_votes = {row['song_id']: row['count'] for row in votes_rows}
+    conn = get_db()
+    snapshot = get_event_snapshot(conn, event_code)
+    if not snapshot:
+        return jsonify({'error': 'Event not found'}), 404
+    
+    return jsonify({
+        **snapshot,
+        'user_votes_used': get_user_vote_count(event_code, session.get('voter_id'))
+    })
 
-        # Count total voters
-        total_voters = conn.execute('SELECT COUNT(DISTINCT user_id) as count FROM votes WHERE event_code = ?', (event_code,)).fetchone()['count']
+def build_track_list(conn, event, snapshot, voter_id):
+    """Build metadata and votes for tracks already voted in a loaded event, as (payload, status)"""
+    event_code = event['code']
+    # Snapshot vote counts double as the list of distinct songs voted for in this event
+    counts = snapshot['votes']
+    song_ids = list(counts)
+    
+    if not song_ids:
+        return {'tracks': [], 'user_votes_used': 0}, 200
+    
+    try:
+        # Spotify (and so a token) is only needed for tracks missing from the cache
+        missing = missing_track_ids(song_ids)
+        if missing:
+            # Resolve and refresh the token (prefer admin token from DB)
+            token_info = get_valid_token(prefer_admin=True, event=event)
+            if not token_info:
+                return {'error': 'Not authenticated'}, 401
+            fetch_tracks_metadata(get_spotify_client(token_info), missing)
+        tracks_meta = get_tracks_metadata(song_ids)
+        my_votes = get_voted_songs(conn, event_code, voter_id)
+        added_songs = get_added_songs(conn, event_code)
+
+        result = [{
+            **t,
+            'votes': counts.get(t['id'], 0),
+            'has_voted': t['id'] in my_votes,
+            'is_added': t['id'] in added_songs
+        } for t in tracks_meta]
         
-        return jsonify({
-            'code': event['code'],
-            'playlist_name': event['playlist_name'],
-            'threshold': event['threshold'],
-            'votes': song_votes,
-            'total_voters': total_voters,
-            'user_votes_used': get_user_vote_count(event_code, session.get('voter_id'))
-        })
+        result.sort(key=itemgetter('votes'), reverse=True)
+        return {
+            'tracks': result,
+            'user_votes_used': len(my_votes)
+        }, 200
+    except Exception as e:
+        logger.error("Fetching tracks failed: %s", e)
+        return {'error': str(e)}, 500
 
 @app.route('/api/event-current-tracks/<event_code>')
 def get_event_current_tracks(event_code):
     """Get metadata and votes for tracks already voted in this event"""
-    with get_db() as conn:
-        event = conn.execute('SELECT * FROM events WHERE code = ?', (event_code,)).fetchone()
-    
+    conn = get_db()
+    event, snapshot = load_event(conn, event_code)
     if not event:
         return jsonify({'tracks': []})
+    payload, status = build_track_list(conn, event, snapshot, session.get('voter_id'))
+    return jsonify(payload), status
+
+@app.route('/api/event-bundle/<event_code>')
+def get_event_bundle(event_code):
+    """Event details, voted tracks and stats in one response for the dashboard poll"""
+    conn = get_db()
+    event, snapshot = load_event(conn, event_code)
+    if not event:
+        return jsonify({'error': 'Event not found'}), 404
     
-    with get_db() as conn:
-        # Get all distinct songs voted for in this event
-        voted_songs = conn.execute('SELECT DISTINCT song_id FROM votes WHERE event_code = ?', (event_code,)).fetchall()
-        song_ids = [row['song_id'] for row in voted_songs]
-    
-    if not song_ids:
-        return jsonify({'tracks': []})
+    voter_id = session.get('voter_id')
+    tracks, _ = build_track_list(conn, event, snapshot, voter_id)
+    user_votes_used = tracks.get('user_votes_used')
+    if user_votes_used is None:
+        user_votes_used = get_user_vote_count(event_code, voter_id)
     
-    # Resolve token (prefer admin token from DB)
-    token_info = DBAdapter.convert_json(event['admin_token'])
-    if not token_info:
-        token_info = session.get('token_info')
-    if not token_info:
-        sp_oauth = get_spotify_oauth()
-        token_info = sp_oauth.get_cached_token()
-    if not token_info:
-        return jsonify({'error': 'Not authenticated'}), 401
+    return jsonify({
+        'event': {**snapshot, 'user_votes_used': user_votes_used},
+        'tracks': tracks,
+        'stats': build_event_stats(snapshot)
+    })
+
+@app.route('/qr/<event_code>.svg')
+def event_qr_code(event_code):
+    """Serve the event's join QR code as a browser-cacheable SVG"""
+    if not event_exists(get_db(), event_code):
+        return jsonify({'error': 'Event not found'}), 404
     
     try:
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-        
-        tracks_meta = []
-        # Spotify tracks API supports up to 50 IDs per call
-        for i in range(0, len(song_ids), 50):
-            chunk = song_ids[i:i+50]
-            resp = sp.tracks(chunk)
-            tracks_meta.extend(resp.get('tracks', []))
-        
-        voter_id = session.get('voter_id')
-        result = []
-        
-        added_songs = DBAdapter.convert_set(event['added_songs'])
-        
-        with get_db() as conn:
-            # helper to get vote count for each song
-            # optimization: we could do one query earlier, but loop is fine for small scale
-            # let's just re-fetch all votes for this event to be efficient
-            all_votes_rows = conn.execute('SELECT song_id, user_id FROM votes WHERE event_code = ?', (event_code,)).fetchall()
-            
-            # Organize votes by song
-            votes_map = {}
-            for row in all_votes_rows:
-                sid = row['song_id']
-                uid = row['user_id']
-                if sid not in votes_map: votes_map[sid] = set()
-                votes_map[sid].add(uid)
-
-        for t in tracks_meta:
-            if not t: continue 
-            sid = t['id']
-            curr_votes = votes_map.get(sid, set())
-            vote_count = len(curr_votes)
-            has_voted = voter_id in curr_votes
-            is_added = sid in added_songs
-            result.append({
-                'id': sid,
-                'name': t['name'],
-                'artist': ', '.join([a['name'] for a in (t.get('artists') or [])]),
-                'image': (t.get('album', {}).get('images', [{}]) or [{}])[0].get('url', ''),
-                'spotify_uri': t.get('uri'),
-                'votes': vote_count,
-                'has_voted': has_voted,
-                'is_added': is_added
-            })
-        
-        result.sort(key=lambda x: x['votes'], reverse=True)
-        return jsonify({
-            'tracks': result,
-            'user_votes_used': get_user_vote_count(event_code, voter_id)
-        })
+        # Use external URL for QR code
+        join_url = url_for('join_event', event_code=event_code, _external=True)
+        logger.debug("Generating QR for URL: %s", join_url)
+        svg = _qr_svg(join_url)
     except Exception as e:
-        print(f"[ERROR] Fetching tracks failed: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("QR Code generation failed: %s", e)
+        return jsonify({'error': f'QR code error: {str(e)}'}), 500
+    
+    return app.response_class(svg, mimetype='image/svg+xml', headers={
+        'Cache-Control': 'public, max-age=86400, immutable'
+    })
 
 @app.route('/join/<event_code>')
 def join_event(event_code):
     """Join an event"""
-    with get_db() as conn:
-        event = conn.execute('SELECT code FROM events WHERE code = ?', (event_code,)).fetchone()
-    
-    if not event:
+    if not event_exists(get_db(), event_code):
         return render_template('error.html', error='Event not found')
     
     session['event_code'] = event_code
@@ -399,16 +822,13 @@ def voting_dashboard():
         return redirect(url_for('index'))
 
     # Verify event exists in DB
-    with get_db() as conn:
-        event = conn.execute('SELECT code FROM events WHERE code = ?', (event_code,)).fetchone()
-    
-    if not event:
-        print(f"[DEBUG] Invalid or missing event code: {event_code}")
+    if not event_exists(get_db(), event_code):
+        logger.debug("Invalid or missing event code: %s", event_code)
         return redirect(url_for('index'))
     
     # Ensure session is synced
     if session.get('event_code') != event_code:
-        print(f"[DEBUG] Syncing session for event: {event_code}")
+        logger.debug("Syncing session for event: %s", event_code)
         session['event_code'] = event_code
     
     # Ensure voter_id exists
@@ -417,126 +837,93 @@ def voting_dashboard():
     
     return render_template('voting_dashboard.html')
 
+def get_admin_token(conn, event):
+    """Get the event admin's stored Spotify token (events from before admin_tokens keep their own copy)"""
+    row = conn.execute(SQL_ADMIN_TOKEN, (event['admin_id'],)).fetchone()
+    if row:
+        return DBAdapter.convert_json(row['token_info'])
+    return DBAdapter.convert_json(event['admin_token'])
+
+def save_admin_token(conn, spotify_user_id, token_info):
+    """Store the one canonical token for an admin, shared by all their events and workers"""
+    conn.execute('''
+        INSERT INTO admin_tokens (spotify_user_id, token_info) VALUES (?, ?)
+        ON CONFLICT (spotify_user_id) DO UPDATE SET token_info = excluded.token_info
+    ''', (spotify_user_id, DBAdapter.adapt_json(token_info)))
+
 def ensure_valid_token(token_info):
     """Check if token is expired and refresh if necessary"""
     try:
         sp_oauth = get_spotify_oauth()
         if sp_oauth.is_token_expired(token_info):
-            print(f"[DEBUG] Token expired, refreshing...")
+            logger.debug("Token expired, refreshing...")
             new_token = sp_oauth.refresh_access_token(token_info['refresh_token'])
+            # The old access token is dead, so its cached client is too
+            _spotify_clients.pop(token_info['access_token'], None)
             return new_token
     except Exception as e:
-        print(f"[ERROR] Token refresh failed: {e}")
+        logger.error("Token refresh failed: %s", e)
     return token_info
 
+def require_search_query():
+    """Reject a search without a query before any token lookup"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('query'):
+        logger.warning("Search query missing")
+        return jsonify({'error': 'Query is required'}), 400
+
 @app.route('/api/search-songs', methods=['POST'])
+@with_valid_token('Not authenticated. Please join an active event.', validate=require_search_query)
 def search_songs():
     """Search Spotify songs"""
     try:
         data = request.json
         query = data.get('query')
         
-        if not query:
-            print("[WARN] Search query missing")
-            return jsonify({'error': 'Query is required'}), 400
-        
-        print(f"[DEBUG] Processing search for: '{query}'")
+        logger.debug("Processing search for: '%s'", query)
         
         event_code = session.get('event_code')
-        token_info = None
-        source = "None"
-        
-        # 1. Try Session Token
-        if 'token_info' in session:
-            token_info = session['token_info']
-            source = "Session"
+        sp = g.sp
         
-        # 2. Try Admin Token Fallback (if event exists)
-        event = None
-        if not token_info and event_code:
-            with get_db() as conn:
-                event = conn.execute('SELECT * FROM events WHERE code = ?', (event_code,)).fetchone()
-            
-            if event:
-                token_info = DBAdapter.convert_json(event['admin_token'])
-                source = "Event Admin"
-            
-        if not token_info:
-            print("[ERROR] No authentication token found in session or event")
-            return jsonify({'error': 'Not authenticated. Please join an active event.'}), 401
-            
-        # 3. Ensure Token Validity
-        token_info = ensure_valid_token(token_info)
+        logger.debug("Calling Spotify Search API...")
+        limit = min(max(int(data.get('limit', SPOTIFY_PAGE_LIMIT)), 1), SPOTIFY_PAGE_LIMIT)
+        results = sp.search(q=query, type='track', limit=limit)
         
-        # Update session/event if refreshed
-        if source == "Session":
-            session['token_info'] = token_info
-        elif source == "Event Admin" and event:
-            # Update DB with new token
-            with get_db() as conn:
-                conn.execute('UPDATE events SET admin_token = ? WHERE code = ?', 
-                             (DBAdapter.adapt_json(token_info), event_code))
-                conn.commit()
-
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-        
-        print(f"[DEBUG] Calling Spotify Search API (Source: {source})...")
-        results = sp.search(q=query, type='track', limit=10)
-        
-        tracks = []
         voter_id = session.get('voter_id')
         
         # Get vote counts for this event
-        event_votes_map = {}
+        counts, my_votes = {}, set()
         added_songs = set()
         
         if event_code:
-            with get_db() as conn:
-                votes_rows = conn.execute('SELECT song_id, user_id FROM votes WHERE event_code = ?', (event_code,)).fetchall()
-                for row in votes_rows:
-                    sid = row['song_id']
-                    if sid not in event_votes_map: event_votes_map[sid] = set()
-                    event_votes_map[sid].add(row['user_id'])
-                
-                # refresh event to get added songs
-                if not event:
-                    event = conn.execute('SELECT added_songs FROM events WHERE code = ?', (event_code,)).fetchone()
-                if event:
-                    added_songs = DBAdapter.convert_set(event['added_songs'])
+            conn = get_db()
+            event, snapshot = load_event(conn, event_code)
+            if event:
+                counts = snapshot['votes']
+                my_votes = get_voted_songs(conn, event_code, voter_id)
+                added_songs = get_added_songs(conn, event_code)
 
         items = results.get('tracks', {}).get('items', [])
-        print(f"[DEBUG] Spotify returned {len(items)} items")
-
-        for track in items:
-            tid = track['id']
-            curr_votes = event_votes_map.get(tid, set())
-            vote_count = len(curr_votes)
-            has_voted = voter_id in curr_votes if voter_id else False
-            is_added = tid in added_songs
-            
-            tracks.append({
-                'id': tid,
-                'name': track['name'],
-                'artist': ', '.join([artist['name'] for artist in track['artists']]),
-                'image': track['album']['images'][0]['url'] if track['album']['images'] else '',
-                'spotify_uri': track['uri'],
-                'votes': vote_count,
-                'has_voted': has_voted,
-                'is_added': is_added
-            })
+        logger.debug("Spotify returned %s items", len(items))
+
+        # Search results carry full track objects, so they also warm the metadata cache
+        tracks = [{
+            **t,
+            'votes': counts.get(t['id'], 0),
+            'has_voted': t['id'] in my_votes,
+            'is_added': t['id'] in added_songs
+        } for t in cache_tracks(items)]
         
         return jsonify({
             'tracks': tracks,
-            'user_votes_used': get_user_vote_count(event_code, voter_id)
+            'user_votes_used': len(my_votes)
         })
     
     except spotipy.exceptions.SpotifyException as se:
-        print(f"[ERROR] Spotify API Error: {se}")
+        logger.error("Spotify API Error: %s", se)
         return jsonify({'error': f"Spotify Error: {se.msg}"}), 400
     except Exception as e:
-        print(f"[ERROR] Search failed with exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Search failed with exception: %s", e)
         return jsonify({'error': f'Search error: {str(e)}'}), 400
 
 def get_user_vote_count(event_code, voter_id):
@@ -544,10 +931,109 @@ def get_user_vote_count(event_code, voter_id):
     if not event_code or not voter_id:
         return 0
     
-    with get_db() as conn:
-        count = conn.execute('SELECT COUNT(*) as count FROM votes WHERE event_code = ? AND user_id = ?', (event_code, voter_id)).fetchone()['count']
+    conn = get_db()
+    count = conn.execute(SQL_USER_VOTE_COUNT, (event_code, voter_id)).fetchone()['count']
     return count
 
+# A pending claim is abandoned (its worker died mid-add) once it is older than
+# a playlist add can take (see PLAYLIST_ADD_BUDGET), and may then be claimed again
+PENDING_CLAIM_TIMEOUT = 300
+
+def claim_cutoff():
+    """Claim time before which a pending add counts as abandoned"""
+    return time.time() - PENDING_CLAIM_TIMEOUT
+
+def get_added_songs(conn, event_code):
+    """Set of song ids added, or being added, to an event's playlist"""
+    return {row['song_id'] for row in conn.execute(SQL_ADDED_SONGS, (event_code, claim_cutoff()))}
+
+def _change_added_songs(conn, event_code, sql, params):
+    """Run a claim/release on an event's added_songs; True if it changed a row"""
+    with transaction(conn):
+        changed = conn.execute(sql, params).rowcount == 1
+        # Dashboards show added songs, so a change counts as a new vote version
+        if changed:
+            conn.execute(SQL_BUMP_VERSION, (event_code,))
+    if changed:
+        notify_vote_changed(event_code)
+    return changed
+
+def claim_added_song(conn, event_code, song_id):
+    """Atomically claim a song's playlist add; the claim time identifies the claim, None if already taken"""
+    # The primary key makes the insert a claim: concurrent workers cannot both
+    # add the same song, and only an abandoned pending claim can be taken over
+    claimed_at = time.time()
+    params = (event_code, song_id, claimed_at, claimed_at - PENDING_CLAIM_TIMEOUT)
+    return claimed_at if _change_added_songs(conn, event_code, SQL_CLAIM_ADDED, params) else None
+
+def release_added_song(conn, event_code, song_id, claimed_at):
+    """Drop a pending claim so a later vote can retry the add; False if it was taken over"""
+    return _change_added_songs(conn, event_code, SQL_RELEASE_ADDED, (event_code, song_id, claimed_at))
+
+def confirm_added_song(conn, event_code, song_id, claimed_at):
+    """Mark a claimed song as added, retrying the write alone so Spotify is never asked twice"""
+    for attempt in range(1, PLAYLIST_ADD_ATTEMPTS + 1):
+        try:
+            if conn.execute(SQL_CONFIRM_ADDED, (event_code, song_id, claimed_at)).rowcount != 1:
+                logger.warning("Claim on song %s in event %s was taken over before it was confirmed", song_id, event_code)
+            return
+        except sqlite3.OperationalError as e:
+            logger.error("Failed to confirm added song (attempt %s/%s): %s", attempt, PLAYLIST_ADD_ATTEMPTS, e)
+            if attempt < PLAYLIST_ADD_ATTEMPTS:
+                time.sleep(attempt)
+
+# Playlist adds run off the request thread so /api/vote never waits on Spotify
+PLAYLIST_ADD_ATTEMPTS = 3
+# No attempt starts after this many seconds. One attempt is bounded by the request
+# timeouts (token refresh plus an add with connection retries, about 75 s), so a
+# claim is confirmed or released well inside PENDING_CLAIM_TIMEOUT
+PLAYLIST_ADD_BUDGET = 90
+playlist_executor = ThreadPoolExecutor(max_workers=4)
+
+def add_song_to_playlist(event_code, song_id, claimed_at):
+    """Background task: add a claimed song to the event playlist, releasing the claim if it fails"""
+    conn = connect_db()
+    event = conn.execute(SQL_EVENT, (event_code,)).fetchone()
+    deadline = time.monotonic() + PLAYLIST_ADD_BUDGET
+    for attempt in range(1, PLAYLIST_ADD_ATTEMPTS + 1):
+        if time.monotonic() >= deadline:
+            logger.error("Gave up adding song %s in event %s after %ss", song_id, event_code, PLAYLIST_ADD_BUDGET)
+            break
+        try:
+            # Resolve admin token, refreshing it for every worker if expired
+            stored_token = get_admin_token(conn, event)
+            token_info = ensure_valid_token(stored_token)
+            if not token_info:
+                logger.error("No admin token to add song %s in event %s", song_id, event_code)
+                break
+            if token_info is not stored_token:
+                save_admin_token(conn, event['admin_id'], token_info)
+            
+            sp = get_spotify_client(token_info)
+            sp.playlist_add_items(event['playlist_id'], [f'spotify:track:{song_id}'])
+        except Exception as e:
+            logger.error("Failed to add song to playlist (attempt %s/%s): %s", attempt, PLAYLIST_ADD_ATTEMPTS, e)
+            if attempt < PLAYLIST_ADD_ATTEMPTS:
+                time.sleep(2 ** attempt)
+            continue
+        logger.debug("Song %s added to playlist successfully", song_id)
+        confirm_added_song(conn, event_code, song_id, claimed_at)
+        return
+    
+    # Release the claim so a later vote can retry the add
+    release_added_song(conn, event_code, song_id, claimed_at)
+
+def requeue_stale_claims():
+    """Retry playlist adds whose worker died before confirming or releasing them"""
+    conn = connect_db()
+    for row in conn.execute(SQL_STALE_CLAIMS, (claim_cutoff(),)).fetchall():
+        # Every worker runs this on startup; the claim lets exactly one retry each song
+        claimed_at = claim_added_song(conn, row['event_code'], row['song_id'])
+        if claimed_at:
+            playlist_executor.submit(add_song_to_playlist, row['event_code'], row['song_id'], claimed_at)
+
+requeue_stale_claims()
+
 @app.route('/api/vote', methods=['POST'])
 def vote():
     """Vote for a song"""
@@ -560,92 +1046,75 @@ def vote():
         if not event_code or not song_id or not voter_id:
             return jsonify({'error': 'Missing event, song, or voter ID'}), 400
         
-        with get_db() as conn:
-            event = conn.execute('SELECT * FROM events WHERE code = ?', (event_code,)).fetchone()
-            
-            if not event:
-                return jsonify({'error': 'Invalid event'}), 400
+        conn = get_db()
+        event = conn.execute(SQL_EVENT, (event_code,)).fetchone()
         
-            # Check if song is already added
-            added_songs = DBAdapter.convert_set(event['added_songs'])
-            if song_id in added_songs:
+        if not event:
+            return jsonify({'error': 'Invalid event'}), 400
+        
+        logger.debug("Vote from %s for song %s in event %s", voter_id, song_id, event_code)
+        
+        # Check the song is still open for votes, toggle the vote and read both
+        # counters back in one transaction: the insert reports whether it took,
+        # a duplicate means the vote is removed
+        with transaction(conn):
+            if conn.execute(SQL_IS_ADDED, (event_code, song_id, claim_cutoff())).fetchone():
                 return jsonify({
                     'success': False,
                     'error': 'Song already added to playlist',
                     'is_added': True
                 })
 
-            print(f"[DEBUG] Vote from {voter_id} for song {song_id} in event {event_code}")
-            
-            # Check if user already voted for this song
-            existing_vote = conn.execute('SELECT 1 FROM votes WHERE event_code = ? AND song_id = ? AND user_id = ?', 
-                                         (event_code, song_id, voter_id)).fetchone()
-            is_removing = existing_vote is not None
-            
-            # Check vote limit (Max 3) - Only if adding
-            if not is_removing:
-                user_vote_count = conn.execute('SELECT COUNT(*) as count FROM votes WHERE event_code = ? AND user_id = ?', 
-                                              (event_code, voter_id)).fetchone()['count']
-                if user_vote_count >= 3:
-                    return jsonify({
-                        'success': False, 
-                        'error': 'You have used all 3 votes!',
-                        'vote_limit_reached': True
-                    })
-
-            # Toggle vote
-            if is_removing:
-                conn.execute('DELETE FROM votes WHERE event_code = ? AND song_id = ? AND user_id = ?',
-                             (event_code, song_id, voter_id))
+            inserted = conn.execute(SQL_VOTE_INSERT, (event_code, song_id, voter_id)).fetchone()
+            if inserted is None:
+                conn.execute(SQL_VOTE_DELETE, (event_code, song_id, voter_id))
                 action = 'removed'
             else:
-                conn.execute('INSERT INTO votes (event_code, song_id, user_id) VALUES (?, ?, ?)',
-                             (event_code, song_id, voter_id))
                 action = 'added'
-            conn.commit()
-            
-            # Get updated stats
-            vote_count = conn.execute('SELECT COUNT(*) as count FROM votes WHERE event_code = ? AND song_id = ?',
-                                      (event_code, song_id)).fetchone()['count']
-            user_votes_used = conn.execute('SELECT COUNT(*) as count FROM votes WHERE event_code = ? AND user_id = ?',
-                                          (event_code, voter_id)).fetchone()['count']
-            
-            threshold = event['threshold']
-            print(f"[DEBUG] Vote count: {vote_count}, Threshold: {threshold}")
+
+            counts = conn.execute(SQL_VOTE_COUNTERS, (song_id, voter_id, event_code, song_id, voter_id)).fetchone()
+            vote_count, user_votes_used = counts['song_c'], counts['user_c']
+
+            # Enforce the vote limit (Max 3) by undoing an insert that exceeded it
+            limit_reached = action == 'added' and user_votes_used > 3
+            if limit_reached:
+                conn.execute(SQL_VOTE_DELETE, (event_code, song_id, voter_id))
+            else:
+                # Bump the event's vote version and keep its voter counter in
+                # step (a voter counts while holding a vote)
+                if action == 'added' and user_votes_used == 1:
+                    voters_delta = 1
+                elif action == 'removed' and user_votes_used == 0:
+                    voters_delta = -1
+                else:
+                    voters_delta = 0
+                conn.execute(SQL_VOTE_STATE, (voters_delta, event_code))
+
+        if limit_reached:
+            return jsonify({
+                'success': False, 
+                'error': 'You have used all 3 votes!',
+                'vote_limit_reached': True
+            })
+        notify_vote_changed(event_code)
+        
+        threshold = event['threshold']
+        logger.debug("Vote count: %s, Threshold: %s", vote_count, threshold)
+        
+        # Check threshold; only the request that claims the song adds it
+        claimed_at = claim_added_song(conn, event_code, song_id) if vote_count >= threshold else None
+        if claimed_at:
+            logger.debug("Threshold reached! Queueing playlist add...")
+            playlist_executor.submit(add_song_to_playlist, event_code, song_id, claimed_at)
             
-            # Check threshold
-            if vote_count >= threshold:
-                try:
-                    # Resolve admin token
-                    token_info = DBAdapter.convert_json(event['admin_token'])
-                    # We might need to refresh it here too, similar to search
-                    token_info = ensure_valid_token(token_info)
-                    
-                    if token_info:
-                        print(f"[DEBUG] Threshold reached! Adding song to playlist...")
-                        sp = spotipy.Spotify(auth=token_info['access_token'])
-                        playlist_id = event['playlist_id']
-                        sp.playlist_add_items(playlist_id, [f'spotify:track:{song_id}'])
-                        
-                        # Mark as added
-                        added_songs.add(song_id)
-                        conn.execute('UPDATE events SET added_songs = ? WHERE code = ?',
-                                     (DBAdapter.adapt_set(added_songs), event_code))
-                        conn.commit()
-                        
-                        print(f"[DEBUG] Song added to playlist successfully")
-                        
-                        return jsonify({
-                            'success': True,
-                            'action': action,
-                            'vote_count': vote_count,
-                            'user_votes_used': user_votes_used,
-                            'threshold_reached': True,
-                            'message': 'Song added to playlist!'
-                        })
-                except Exception as e:
-                    print(f"[ERROR] Failed to add song to playlist: {e}")
-                    return jsonify({'error': f'Could not add to playlist: {str(e)}'}), 400
+            return jsonify({
+                'success': True,
+                'action': action,
+                'vote_count': vote_count,
+                'user_votes_used': user_votes_used,
+                'threshold_reached': True,
+                'message': 'Adding song to playlist!'
+            })
         
         return jsonify({
             'success': True,
@@ -656,42 +1125,74 @@ def vote():
         })
     
     except Exception as e:
-        print(f"[ERROR] Vote failed: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Vote failed: %s", e)
         return jsonify({'error': str(e)}), 400
 
 @app.route('/api/event-stats/<event_code>')
 def get_event_stats(event_code):
     """Get real-time event statistics"""
-    with get_db() as conn:
-        event = conn.execute('SELECT threshold FROM events WHERE code = ?', (event_code,)).fetchone()
-        
-        if not event:
-            return jsonify({'error': 'Event not found'}), 404
-        
-        # Get counts for all songs
-        rows = conn.execute('SELECT song_id, COUNT(*) as count FROM votes WHERE event_code = ? GROUP BY song_id', (event_code,)).fetchall()
-        
-        total_voters = conn.execute('SELECT COUNT(DISTINCT user_id) as count FROM votes WHERE event_code = ?', (event_code,)).fetchone()['count']
-
-    songs_data = []
-    for row in rows:
-        songs_data.append({
-            'song_id': row['song_id'],
-            'votes': row['count'],
-            'threshold': event['threshold']
-        })
+    conn = get_db()
+    snapshot = get_event_snapshot(conn, event_code)
     
-    songs_data.sort(key=lambda x: x['votes'], reverse=True)
+    if not snapshot:
+        return jsonify({'error': 'Event not found'}), 404
+
+    # Stats only change on a vote, so pollers revalidate against the vote version
+    etag = f"{event_code}-{snapshot['version']}"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_event_stats(snapshot))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/event-stream/<event_code>')
+def event_stream(event_code):
+    """Server-Sent Events stream sending an event's vote counts at each new vote version"""
+    conn = get_db()
+    row = conn.execute(SQL_EVENT_VERSION, (event_code,)).fetchone()
+    if not row:
+        return jsonify({'error': 'Event not found'}), 404
     
-    return jsonify({
-        'songs': songs_data,
-        'total_voters': total_voters,
-        'threshold': event['threshold']
-    })
+    # A reconnecting browser sends the last version it saw, so nothing is missed between streams
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    sent_version = int(last_event_id) if last_event_id.isdigit() else row['version']
+    cond = _vote_conditions.setdefault(event_code, threading.Condition())
+    
+    if not _stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many open streams, poll instead'}), 503, {'Retry-After': str(STREAM_MAX_AGE)}
+    
+    def generate(sent_version):
+        # Runs after the request context is gone, so use the thread's connection directly
+        conn = connect_db()
+        deadline = time.monotonic() + STREAM_MAX_AGE
+        yield 'retry: 2000\n\n'
+        while time.monotonic() < deadline:
+            # Dashboards apply the shared per-version counts directly, so a vote
+            # does not turn into a bundle fetch from every open dashboard
+            event, snapshot = load_event(conn, event_code)
+            if not event:
+                return
+            if snapshot['version'] != sent_version:
+                sent_version = snapshot['version']
+                update = {'version': sent_version, 'votes': snapshot['votes'],
+                          'total_voters': snapshot['total_voters']}
+                yield f"id: {sent_version}\ndata: {orjson.dumps(update).decode()}\n\n"
+                # Votes arriving meanwhile are picked up by the next check
+                time.sleep(STREAM_MIN_INTERVAL)
+                continue
+            yield ': keepalive\n\n'
+            with cond:
+                cond.wait(STREAM_CHECK_INTERVAL)
+    
+    response = app.response_class(generate(sent_version), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The server closes the response even if the stream never started, so free the slot there
+    response.call_on_close(_stream_slots.release)
+    return response
 
 if __name__ == '__main__':
     # Use 0.0.0.0 to be accessible from other devices in the network
-    print("[DEBUG] Starting Flask app on http://0.0.0.0:5000")
+    logger.info("Starting Flask app on http://0.0.0.0:5000")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file